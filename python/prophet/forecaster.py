@@ -15,7 +15,7 @@ import numpy as np
 import pandas as pd
 
 from prophet.make_holidays import get_holiday_names, make_holidays_df
-from prophet.models import StanBackendEnum
+from prophet.models import StanBackendEnum, get_backend_class
 from prophet.plot import (plot, plot_components)
 
 logger = logging.getLogger('prophet')
@@ -149,7 +149,7 @@ class Prophet(object):
                 except Exception as e:
                     logger.debug("Unable to load backend %s (%s), trying the next one", i.name, e)
         else:
-            self.stan_backend = StanBackendEnum.get_backend_class(stan_backend)()
+            self.stan_backend = get_backend_class(stan_backend)()
 
         logger.debug("Loaded stan backend: %s", self.stan_backend.get_type())
 
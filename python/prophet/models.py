@@ -12,17 +12,33 @@ from enum import Enum
 from pathlib import Path
 import os
 import pickle
-import pkg_resources
 import platform
+import sys
+import threading
+import weakref
+
+import numpy as np
 
 import logging
 logger = logging.getLogger('prophet.models')
 
-PLATFORM = "unix"
-if platform.platform().startswith("Win"):
-    PLATFORM = "win"
+PLATFORM = "win" if sys.platform.startswith("win") else "unix"
+_IS_LINUX_X86_64 = sys.platform.startswith("linux") and platform.machine() == "x86_64"
+
+
+def _bool_option(value) -> bool:
+    """Validate a boolean option without coercing e.g. 'false' to True."""
+    if not isinstance(value, (bool, np.bool_)):
+        raise ValueError(f'Expected a bool, found {value!r}')
+    return bool(value)
+
 
 class IStanBackend(ABC):
+    # Options accepted by set_options: name -> (attribute, conversion)
+    OPTIONS = {
+        'newton_fallback': ('newton_fallback', _bool_option),
+    }
+
     def __init__(self):
         self.model = self.load_model()
         self.stan_fit = None
@@ -30,14 +46,23 @@ class IStanBackend(ABC):
 
     def set_options(self, **kwargs):
         """
-        Specify model options as kwargs.
+        Specify model options as kwargs. The accepted names are the keys of
+        OPTIONS; nothing is set if any name or value is invalid.
          * newton_fallback [bool]: whether to fallback to Newton if L-BFGS fails
+        CmdStanPyBackend also accepts:
+         * cache_X [bool]: reuse the converted X across fits, see
+           prepare_stan_data_cached
+         * history_size [int], tol_rel_obj [float], tol_rel_grad [float],
+           init_alpha [float]: L-BFGS settings passed to cmdstanpy's optimize
         """
+        values = {}
         for k, v in kwargs.items():
-            if k == 'newton_fallback':
-                self.newton_fallback = v
-            else:
+            if k not in self.OPTIONS:
                 raise ValueError(f'Unknown option {k}')
+            attr, cast = self.OPTIONS[k]
+            values[attr] = cast(v)
+        for attr, v in values.items():
+            setattr(self, attr, v)
 
 
     @staticmethod
@@ -60,24 +85,74 @@ class IStanBackend(ABC):
 
 _model_dir_path = Path(os.environ.get("PROPHET_MODEL_DIR_PATH", default=Path.home().joinpath(".prophet")))
 
+# Loaded models keyed by model file path, shared by all backend instances.
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+# Whether each model file was compiled with STAN_THREADS, keyed by path.
+_STAN_THREADS_CACHE = {}
+_downloaded = False
+_TBB_ADDED = False
+
+
+def _download_file(url: str, target_path: Path):
+    """Download url to target_path, writing to a temporary file until complete."""
+    import requests
+
+    logger.info(f"downloading {target_path.name}")
+    tmp_path = target_path.with_name(target_path.name + ".part")
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with tmp_path.open("wb") as f:
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+    tmp_path.chmod(0o755)
+    tmp_path.replace(target_path)
+
 
 class CmdStanPyBackend(IStanBackend):
     CMDSTAN_VERSION = "2.26.1"
+    # Series shorter than this are fit with Newton instead of L-BFGS.
+    NEWTON_THRESHOLD = 100
+    # Default L-BFGS settings, overridable with set_options.
+    BFGS_OPTIONS = {
+        'history_size': 20,
+        'tol_rel_obj': 1e4,
+        'tol_rel_grad': 1e7,
+        'init_alpha': 0.001,
+    }
+    # cache_X makes fit and sampling use prepare_stan_data_cached. The L-BFGS
+    # settings can also be changed with set_options.
+    OPTIONS = {
+        **IStanBackend.OPTIONS,
+        'cache_X': ('cache_X', _bool_option),
+        'history_size': ('history_size', int),
+        'tol_rel_obj': ('tol_rel_obj', float),
+        'tol_rel_grad': ('tol_rel_grad', float),
+        'init_alpha': ('init_alpha', float),
+    }
+
     def __init__(self):
         super().__init__()
+        for k, v in self.BFGS_OPTIONS.items():
+            setattr(self, k, v)
+        self.cache_X = False
+        self._X_cache = None
         # import cmdstanpy
         # cmdstanpy.set_cmdstan_path(
         #     pkg_resources.resource_filename("prophet", f"stan_model/cmdstan-{self.CMDSTAN_VERSION}")
         # )
 
     def download_model_files(self):
-        if (platform.system(), platform.machine()) != ("Linux", "x86_64"):
+        global _downloaded
+        if _downloaded:
+            return
+
+        if not _IS_LINUX_X86_64:
             logger.warning("only Linux x86_64 binary can be downloaded")
             logger.warning("please prepare compiled stan model binary by yourself")
             return
 
-        import requests
-        import shutil
+        from concurrent.futures import ThreadPoolExecutor
 
         if not _model_dir_path.exists():
             _model_dir_path.mkdir()
@@ -87,56 +162,75 @@ class CmdStanPyBackend(IStanBackend):
             "prophet_model.bin": "https://github.com/lucidfrontier45/prophet-nogpl/releases/download/1.0.0/prophet_model.bin"
         }
 
-        for file_name, url in targets.items():
-            target_path = _model_dir_path.joinpath(file_name)
-            if not target_path.exists():
-                logger.info(f"downloading {file_name}")
-                with requests.get(url, stream=True) as r:
-                    with target_path.open("wb") as f:
-                        shutil.copyfileobj(r.raw, f)
-                        target_path.chmod(0o755)
+        missing = [
+            (url, _model_dir_path.joinpath(file_name))
+            for file_name, url in targets.items()
+            if not _model_dir_path.joinpath(file_name).exists()
+        ]
+        if missing:
+            with ThreadPoolExecutor(len(missing)) as executor:
+                # Consume the results so that download errors are raised here.
+                list(executor.map(lambda job: _download_file(*job), missing))
+        _downloaded = True
 
     @staticmethod
     def get_type():
         return StanBackendEnum.CMDSTANPY.name
 
     def _add_tbb_to_path(self):
-        """Add the TBB library to $PATH on Windows only. Required for loading model binaries."""
+        """Add the TBB library to $PATH on Windows or $LD_LIBRARY_PATH on unix.
+
+        Required for loading model binaries. Only runs once per process.
+        """
+        global _TBB_ADDED
+        if _TBB_ADDED:
+            return
+
         if PLATFORM == "win":
+            import pkg_resources
             tbb_path = pkg_resources.resource_filename(
                 "prophet",
                 f"stan_model/cmdstan-{self.CMDSTAN_VERSION}/stan/lib/stan_math/lib/tbb"
             )
-            os.environ["PATH"] = ";".join(
-                list(OrderedDict.fromkeys([tbb_path] + os.environ.get("PATH", "").split(";")))
-            )
-        elif PLATFORM == "unix":
+            env_var, sep = "PATH", ";"
+        else:
             tbb_path = str(_model_dir_path)
-            old = os.environ.get("LD_LIBRARY_PATH")
-            if old:
-                os.environ["LD_LIBRARY_PATH"] = old + ":" + tbb_path
-            else:
-                os.environ["LD_LIBRARY_PATH"] = tbb_path
+            env_var, sep = "LD_LIBRARY_PATH", ":"
+        old = os.environ.get(env_var)
+        if not old:
+            os.environ[env_var] = tbb_path
+        elif tbb_path not in old.split(sep):
+            os.environ[env_var] = tbb_path + sep + old
+        _TBB_ADDED = True
 
     def load_model(self):
-        self.download_model_files()
-        import cmdstanpy
-        self._add_tbb_to_path()
         model_file = str(_model_dir_path.joinpath("prophet_model.bin"))
-        return cmdstanpy.CmdStanModel(exe_file=model_file)
+        with _MODEL_CACHE_LOCK:
+            if model_file not in _MODEL_CACHE:
+                self.download_model_files()
+                import cmdstanpy
+                self._add_tbb_to_path()
+                _MODEL_CACHE[model_file] = cmdstanpy.CmdStanModel(exe_file=model_file)
+            return _MODEL_CACHE[model_file]
 
     def fit(self, stan_init, stan_data, **kwargs):
-        (stan_init, stan_data) = self.prepare_data(stan_init, stan_data)
+        if self.cache_X:
+            stan_data = self.prepare_stan_data_cached(stan_data)
+        else:
+            stan_data = self.prepare_stan_data(stan_data)
+        stan_init = self.prepare_init(stan_init)
 
         if 'inits' not in kwargs and 'init' in kwargs:
-            kwargs['inits'] = self.prepare_data(kwargs['init'], stan_data)[0]
+            kwargs['inits'] = self.prepare_init(kwargs.pop('init'))
 
         args = dict(
             data=stan_data,
             inits=stan_init,
-            algorithm='Newton' if stan_data['T'] < 100 else 'LBFGS',
+            algorithm='Newton' if stan_data['T'] < self.NEWTON_THRESHOLD else 'LBFGS',
             iter=int(1e4),
         )
+        if kwargs.get('algorithm', args['algorithm']) == 'LBFGS':
+            args.update({k: getattr(self, k) for k in self.BFGS_OPTIONS})
         args.update(kwargs)
 
         try:
@@ -148,21 +242,62 @@ class CmdStanPyBackend(IStanBackend):
                     'Optimization terminated abnormally. Falling back to Newton.'
                 )
                 args['algorithm'] = 'Newton'
+                # cmdstanpy rejects L-BFGS settings for Newton
+                for k in self.BFGS_OPTIONS:
+                    args.pop(k, None)
                 self.stan_fit = self.model.optimize(**args)
             else:
                 raise e
 
         params = self.stan_to_dict_numpy(
             self.stan_fit.column_names, self.stan_fit.optimized_params_np)
-        for par in params:
-            params[par] = params[par].reshape((1, -1))
-        return params
+        return {par: a.ravel()[None, :] for par, a in params.items()}
+
+    @classmethod
+    def fit_many(cls, jobs, n_workers=None, **kwargs) -> list:
+        """Fit several independent models in parallel worker processes.
+
+        Parameters
+        ----------
+        jobs: List of (stan_init, stan_data) tuples, one per model.
+        n_workers: Number of worker processes, defaults to os.cpu_count().
+        kwargs: Additional arguments passed to fit for every job.
+
+        Returns
+        -------
+        List of params dicts, in the same order as jobs.
+
+        Set STAN_NUM_THREADS=1 when the number of jobs is at least the number
+        of cores to avoid oversubscribing the CPU.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        if not jobs:
+            return []
+        # Load the model in this process first so that forked workers inherit
+        # it; spawned workers load it once each and reuse it across jobs.
+        # fork is only used on Linux, it is unsafe on macOS.
+        cls()
+        ctx = multiprocessing.get_context(
+            'fork' if sys.platform.startswith('linux') else 'spawn')
+        max_workers = min(n_workers or os.cpu_count(), len(jobs))
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+            futures = [
+                executor.submit(_fit_job, cls, stan_init, stan_data, kwargs)
+                for (stan_init, stan_data) in jobs
+            ]
+            return [future.result() for future in futures]
 
     def sampling(self, stan_init, stan_data, samples, **kwargs) -> dict:
-        (stan_init, stan_data) = self.prepare_data(stan_init, stan_data)
+        if self.cache_X:
+            stan_data = self.prepare_stan_data_cached(stan_data)
+        else:
+            stan_data = self.prepare_stan_data(stan_data)
+        stan_init = self.prepare_init(stan_init)
 
         if 'inits' not in kwargs and 'init' in kwargs:
-            kwargs['inits'] = self.prepare_data(kwargs['init'], stan_data)[0]
+            kwargs['inits'] = self.prepare_init(kwargs.pop('init'))
 
         args = dict(
             data=stan_data,
@@ -171,6 +306,10 @@ class CmdStanPyBackend(IStanBackend):
 
         if 'chains' not in kwargs:
             kwargs['chains'] = 4
+        if self._has_stan_threads():
+            # Run all chains together in a single threaded process.
+            kwargs.setdefault('parallel_chains', kwargs['chains'])
+            kwargs.setdefault('threads_per_chain', 1)
         iter_half = samples // 2
         kwargs['iter_sampling'] = iter_half
         if 'iter_warmup' not in kwargs:
@@ -179,93 +318,128 @@ class CmdStanPyBackend(IStanBackend):
         args.update(kwargs)
 
         self.stan_fit = self.model.sample(**args)
-        res = self.stan_fit.draws()
-        (samples, c, columns) = res.shape
-        res = res.reshape((samples * c, columns))
+        res = self.stan_fit.draws(concat_chains=True)
         params = self.stan_to_dict_numpy(self.stan_fit.column_names, res)
+        return {par: _shape_sampled_param(par, a) for par, a in params.items()}
+
+    def _has_stan_threads(self) -> bool:
+        """Whether the model binary was compiled with STAN_THREADS=true."""
+        exe_file = self.model.exe_file
+        # exe_info runs the binary, so only ask once per model file.
+        with _MODEL_CACHE_LOCK:
+            if exe_file not in _STAN_THREADS_CACHE:
+                info = self.model.exe_info() if hasattr(self.model, 'exe_info') else {}
+                _STAN_THREADS_CACHE[exe_file] = (
+                    str(info.get('STAN_THREADS', 'false')).lower() == 'true')
+            return _STAN_THREADS_CACHE[exe_file]
+
+    @staticmethod
+    def prepare_data(init, data) -> Tuple[dict, dict]:
+        """Convert Prophet's init and data dicts into cmdstanpy inputs.
 
-        for par in params:
-            s = params[par].shape
-            if s[1] == 1:
-                params[par] = params[par].reshape((s[0],))
+        cmdstanpy serializes numpy arrays itself, so arrays are passed through
+        as contiguous float64 arrays rather than converted to Python lists.
+        """
+        return (
+            CmdStanPyBackend.prepare_init(init),
+            CmdStanPyBackend.prepare_stan_data(data),
+        )
 
-            if par in ['delta', 'beta'] and len(s) < 2:
-                params[par] = params[par].reshape((-1, 1))
+    @staticmethod
+    def prepare_init(init) -> dict:
+        """Convert Prophet's init dict into cmdstanpy inits.
 
-        return params
+        Arrays in init are passed through without copying, so preparing the
+        same init again for a refit costs no array work.
+        """
+        return {
+            'k': init['k'],
+            'm': init['m'],
+            'delta': np.asarray(init['delta']),
+            'beta': np.asarray(init['beta']),
+            'sigma_obs': init['sigma_obs']
+        }
 
     @staticmethod
-    def prepare_data(init, data) -> Tuple[dict, dict]:
-        cmdstanpy_data = {
+    def prepare_stan_data(data) -> dict:
+        """Convert Prophet's data dict into cmdstanpy data."""
+        return {
             'T': data['T'],
             'S': data['S'],
             'K': data['K'],
             'tau': data['tau'],
             'trend_indicator': data['trend_indicator'],
-            'y': data['y'].tolist(),
-            't': data['t'].tolist(),
-            'cap': data['cap'].tolist(),
-            't_change': data['t_change'].tolist(),
-            's_a': data['s_a'].tolist(),
-            's_m': data['s_m'].tolist(),
-            'X': data['X'].to_numpy().tolist(),
+            'y': np.ascontiguousarray(data['y'], dtype=np.float64),
+            't': np.ascontiguousarray(data['t'], dtype=np.float64),
+            'cap': np.ascontiguousarray(data['cap'], dtype=np.float64),
+            't_change': np.ascontiguousarray(data['t_change'], dtype=np.float64),
+            's_a': np.ascontiguousarray(data['s_a'], dtype=np.float64),
+            's_m': np.ascontiguousarray(data['s_m'], dtype=np.float64),
+            'X': CmdStanPyBackend._prepare_X(data['X']),
             'sigmas': data['sigmas']
         }
 
-        cmdstanpy_init = {
-            'k': init['k'],
-            'm': init['m'],
-            'delta': init['delta'].tolist(),
-            'beta': init['beta'].tolist(),
-            'sigma_obs': init['sigma_obs']
-        }
-        return (cmdstanpy_init, cmdstanpy_data)
+    def prepare_stan_data_cached(self, data) -> dict:
+        """Same as prepare_stan_data, but reuses the converted regressor matrix.
 
-    @staticmethod
-    def stan_to_dict_numpy(column_names: Tuple[str, ...], data: 'np.array'):
-        import numpy as np
+        When data['X'] is the same object as in the previous call, its
+        conversion is skipped, which is the bulk of the work for repeated fits
+        such as rolling-window forecasts. X must not be modified in place
+        between calls. X objects that cannot be weakly referenced, such as
+        lists, are not cached.
 
-        output = OrderedDict()
+        fit and sampling use this instead of prepare_stan_data only when the
+        cache_X option is set.
+        """
+        cached = self._X_cache
+        if cached is None or cached[0]() is not data['X']:
+            try:
+                ref = weakref.ref(data['X'])
+            except TypeError:
+                return self.prepare_stan_data(data)
+            cached = self._X_cache = (ref, self._prepare_X(data['X']))
+        # _prepare_X returns an already converted array unchanged.
+        return self.prepare_stan_data({**data, 'X': cached[1]})
 
-        prev = None
+    @staticmethod
+    def _prepare_X(X) -> np.ndarray:
+        """Convert X, a DataFrame or array, to a C-contiguous float64 array."""
+        if hasattr(X, 'to_numpy'):
+            X = X.to_numpy(dtype=np.float64)
+        return np.ascontiguousarray(X, dtype=np.float64)
 
-        start = 0
-        end = 0
-        two_dims = len(data.shape) > 1
-        for cname in column_names:
-            if "." in cname:
-                parsed = cname.split(".")
-            else:
-                parsed = cname.split("[")
-
-            curr = parsed[0]
-            if prev is None:
-                prev = curr
-
-            if curr != prev:
-                if prev in output:
-                    raise RuntimeError(
-                        "Found repeated column name"
-                    )
-                if two_dims:
-                    output[prev] = np.array(data[:, start:end])
-                else:
-                    output[prev] = np.array(data[start:end])
-                prev = curr
-                start = end
-                end += 1
-            else:
-                end += 1
+    @staticmethod
+    def stan_to_dict_numpy(column_names: Tuple[str, ...], data: 'np.array'):
+        """Group the columns of data by parameter name.
 
-        if prev in output:
+        The returned arrays are views into data, not copies.
+        """
+        # Columns of one parameter are contiguous, e.g. "beta[1]", "beta[2]"
+        # (or "beta.1" in older cmdstanpy), so a parameter starts wherever
+        # the base name changes.
+        bases = [cname.split(".", 1)[0].split("[", 1)[0] for cname in column_names]
+        starts = [i for i in range(1, len(bases)) if bases[i] != bases[i - 1]]
+        names = [bases[0]] + [bases[i] for i in starts]
+        if len(set(names)) != len(names):
             raise RuntimeError(
                 "Found repeated column name"
             )
-        if two_dims:
-            output[prev] = np.array(data[:, start:end])
-        else:
-            output[prev] = np.array(data[start:end])
-        return output
+        # Splitting the last axis returns views, so no per-parameter copy.
+        return OrderedDict(zip(names, np.split(data, starts, axis=-1)))
+
+
+def _shape_sampled_param(par, a):
+    """Drop the singleton column of scalar parameters; keep delta and beta 2-D."""
+    if a.ndim == 2 and a.shape[1] == 1:
+        a = a.ravel()
+    if par in ('delta', 'beta') and a.ndim < 2:
+        a = a[:, None]
+    return a
+
+
+def _fit_job(backend_class, stan_init, stan_data, kwargs) -> dict:
+    """Fit a single model in a worker process for CmdStanPyBackend.fit_many."""
+    return backend_class().fit(stan_init, stan_data, **kwargs)
 
 
 class PyStanBackend(IStanBackend):
@@ -283,13 +457,10 @@ class PyStanBackend(IStanBackend):
         )
         args.update(kwargs)
         self.stan_fit = self.model.sampling(**args)
-        out = {}
-        for par in self.stan_fit.model_pars:
-            out[par] = self.stan_fit[par]
-            # Shape vector parameters
-            if par in ['delta', 'beta'] and len(out[par].shape) < 2:
-                out[par] = out[par].reshape((-1, 1))
-        return out
+        return {
+            par: _shape_sampled_param(par, self.stan_fit[par])
+            for par in self.stan_fit.model_pars
+        }
 
     def fit(self, stan_init, stan_data, **kwargs) -> dict:
 
@@ -313,21 +484,33 @@ class PyStanBackend(IStanBackend):
             else:
                 raise e
 
-        params = {}
-
-        for par in self.stan_fit.keys():
-            params[par] = self.stan_fit[par].reshape((1, -1))
-
-        return params
+        return {par: a.ravel()[None, :] for par, a in self.stan_fit.items()}
 
     def load_model(self):
         """Load compiled Stan model"""
+        import pkg_resources
         model_file = pkg_resources.resource_filename(
             'prophet',
             'stan_model/prophet_model.pkl',
         )
-        with Path(model_file).open('rb') as f:
-            return pickle.load(f)
+        with _MODEL_CACHE_LOCK:
+            if model_file not in _MODEL_CACHE:
+                with Path(model_file).open('rb') as f:
+                    _MODEL_CACHE[model_file] = pickle.load(f)
+            return _MODEL_CACHE[model_file]
+
+
+_BACKENDS = {
+    'PYSTAN': PyStanBackend,
+    'CMDSTANPY': CmdStanPyBackend,
+}
+
+
+def get_backend_class(name: str) -> IStanBackend:
+    try:
+        return _BACKENDS[name]
+    except KeyError as e:
+        raise ValueError("Unknown stan backend: {}".format(name)) from e
 
 
 class StanBackendEnum(Enum):
@@ -336,7 +519,4 @@ class StanBackendEnum(Enum):
 
     @staticmethod
     def get_backend_class(name: str) -> IStanBackend:
-        try:
-            return StanBackendEnum[name].value
-        except KeyError as e:
-            raise ValueError("Unknown stan backend: {}".format(name)) from e
+        return get_backend_class(name)
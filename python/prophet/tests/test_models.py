@@ -0,0 +1,268 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+from unittest import TestCase, mock, skipUnless
+
+import numpy as np
+import pandas as pd
+from prophet import models
+from prophet.models import CmdStanPyBackend
+
+
+def make_data(T=4, X=None):
+    return {
+        'T': T, 'S': 1, 'K': 2, 'tau': 0.05, 'trend_indicator': 0,
+        'y': np.arange(T, dtype=float),
+        't': np.linspace(0, 1, T),
+        'cap': np.zeros(T),
+        't_change': np.array([0.5]),
+        's_a': np.array([1., 0.]),
+        's_m': np.array([0., 1.]),
+        'X': pd.DataFrame(np.ones((T, 2))) if X is None else X,
+        'sigmas': [10., 10.],
+    }
+
+
+def make_init():
+    return {
+        'k': 0.1, 'm': 0.2, 'delta': np.zeros(1), 'beta': np.zeros(2),
+        'sigma_obs': 1,
+    }
+
+
+class FakeModel(object):
+    """Stand-in for cmdstanpy.CmdStanModel that records optimize calls."""
+    column_names = ('lp__', 'k', 'm', 'delta[1]', 'sigma_obs', 'beta[1]', 'beta[2]')
+
+    def __init__(self, n_failures=0):
+        self.calls = []
+        self.n_failures = n_failures
+
+    def optimize(self, **args):
+        self.calls.append(args)
+        if len(self.calls) <= self.n_failures:
+            raise RuntimeError('Optimization failed')
+        return mock.Mock(
+            column_names=self.column_names,
+            optimized_params_np=np.arange(len(self.column_names), dtype=float)
+            + args['data']['y'][0],
+        )
+
+
+def make_backend(model):
+    with mock.patch.object(CmdStanPyBackend, 'load_model', return_value=model):
+        return CmdStanPyBackend()
+
+
+class TestCmdStanPyBackend(TestCase):
+
+    def test_prepare_data(self):
+        T = 4
+        data = {
+            'T': T, 'S': 1, 'K': 2, 'tau': 0.05, 'trend_indicator': 0,
+            'y': pd.Series(np.arange(T)),
+            't': pd.Series(np.linspace(0, 1, T)),
+            'cap': np.zeros(T),
+            't_change': np.array([0.5]),
+            's_a': pd.Series([1, 0]),
+            's_m': pd.Series([0, 1]),
+            'X': pd.DataFrame(np.ones((T, 2))),
+            'sigmas': [10., 10.],
+        }
+        init = {
+            'k': 0.1, 'm': 0.2, 'delta': np.zeros(1), 'beta': np.zeros(2),
+            'sigma_obs': 1,
+        }
+        stan_init, stan_data = CmdStanPyBackend.prepare_data(init, data)
+        self.assertEqual(stan_data['X'].shape, (T, 2))
+        self.assertTrue(stan_data['X'].flags['C_CONTIGUOUS'])
+        self.assertEqual(stan_data['y'].dtype, np.float64)
+        self.assertEqual(stan_data['s_a'].tolist(), [1., 0.])
+        self.assertEqual(stan_init['beta'].shape, (2,))
+        self.assertIs(CmdStanPyBackend.prepare_init(init)['delta'], init['delta'])
+
+        data['X'] = np.ones((T, 2), dtype=int)
+        stan_data = CmdStanPyBackend.prepare_data(init, data)[1]
+        self.assertEqual(stan_data['X'].dtype, np.float64)
+        self.assertEqual(stan_data['X'].shape, (T, 2))
+
+    def test_prepare_stan_data_cached(self):
+        backend = make_backend(FakeModel())
+        data = make_data()
+        first = backend.prepare_stan_data_cached(data)
+
+        # Hit: same X object, y and cap are refreshed.
+        data2 = dict(data, y=np.full(4, 7.), cap=np.ones(4))
+        second = backend.prepare_stan_data_cached(data2)
+        self.assertIs(second['X'], first['X'])
+        self.assertEqual(second['y'].tolist(), [7.] * 4)
+        self.assertEqual(second['cap'].tolist(), [1.] * 4)
+
+        # Miss: a new X object is converted again.
+        data3 = dict(data, X=pd.DataFrame(np.zeros((4, 2))))
+        third = backend.prepare_stan_data_cached(data3)
+        self.assertIsNot(third['X'], first['X'])
+        self.assertEqual(third['X'].sum(), 0.)
+
+        # X that cannot be weakly referenced is converted without caching.
+        data4 = dict(data, X=[[1, 2]] * 4)
+        self.assertEqual(backend.prepare_stan_data_cached(data4)['X'].shape, (4, 2))
+        self.assertIs(backend.prepare_stan_data_cached(data3)['X'], third['X'])
+
+    def test_fit_cache_X_option(self):
+        model = FakeModel()
+        backend = make_backend(model)
+        data = make_data(X=pd.DataFrame(np.ones((4, 2))))
+        backend.fit(make_init(), data)
+        data['X'].iloc[0, 0] = 99.
+        backend.fit(make_init(), data)
+        self.assertEqual(model.calls[1]['data']['X'][0, 0], 99.)
+
+        backend.set_options(cache_X=True)
+        backend.fit(make_init(), data)
+        backend.fit(make_init(), data)
+        self.assertIs(model.calls[3]['data']['X'], model.calls[2]['data']['X'])
+
+        data['X'] = [[1., 2.]] * 4
+        backend.fit(make_init(), data)
+        self.assertEqual(model.calls[4]['data']['X'].shape, (4, 2))
+
+    def test_stan_to_dict_numpy(self):
+        column_names = (
+            'lp__', 'k', 'm', 'delta[1]', 'delta[2]', 'sigma_obs',
+            'beta.1', 'beta.2', 'beta.3',
+        )
+        data = np.arange(2 * len(column_names), dtype=float).reshape((2, -1))
+        out = CmdStanPyBackend.stan_to_dict_numpy(column_names, data)
+        self.assertEqual(
+            list(out.keys()),
+            ['lp__', 'k', 'm', 'delta', 'sigma_obs', 'beta'],
+        )
+        self.assertEqual(out['delta'].shape, (2, 2))
+        self.assertEqual(out['beta'].shape, (2, 3))
+        self.assertTrue(np.array_equal(out['beta'], data[:, 6:9]))
+        self.assertTrue(np.shares_memory(out['beta'], data))
+
+        flat = CmdStanPyBackend.stan_to_dict_numpy(column_names, data[0])
+        self.assertTrue(np.array_equal(flat['delta'], data[0, 3:5]))
+
+    @skipUnless(sys.platform.startswith('linux'), 'workers are forked on Linux only')
+    def test_fit_many(self):
+        jobs = [(make_init(), make_data()) for _ in range(3)]
+        for i, (_, data) in enumerate(jobs):
+            data['y'] = data['y'] + i
+        with mock.patch.object(CmdStanPyBackend, 'load_model', return_value=FakeModel()):
+            results = CmdStanPyBackend.fit_many(jobs, n_workers=8)
+        self.assertEqual([res['k'][0, 0] for res in results], [1., 2., 3.])
+        self.assertEqual(results[0]['beta'].shape, (1, 2))
+        self.assertEqual(CmdStanPyBackend.fit_many([]), [])
+
+    def test_set_options(self):
+        backend = make_backend(FakeModel())
+        other = make_backend(FakeModel())
+        backend.set_options(history_size='7', newton_fallback=False)
+        self.assertEqual(backend.history_size, 7)
+        self.assertFalse(backend.newton_fallback)
+        # Overrides are per instance.
+        self.assertEqual(other.history_size, 20)
+        self.assertTrue(other.newton_fallback)
+        self.assertEqual(CmdStanPyBackend.BFGS_OPTIONS['history_size'], 20)
+
+        with self.assertRaises(ValueError):
+            backend.set_options(tol_rel_obj=5., unknown=1)
+        self.assertEqual(backend.tol_rel_obj, 1e4)
+
+        with self.assertRaises(ValueError):
+            backend.set_options(init_alpha=0.1, newton_fallback='true')
+        self.assertEqual(backend.init_alpha, 0.001)
+        self.assertFalse(backend.newton_fallback)
+
+    def test_fit_bfgs_options(self):
+        bfgs_keys = set(CmdStanPyBackend.BFGS_OPTIONS)
+        T = CmdStanPyBackend.NEWTON_THRESHOLD
+
+        model = FakeModel()
+        make_backend(model).fit(make_init(), make_data(T))
+        args = model.calls[0]
+        self.assertEqual(args['algorithm'], 'LBFGS')
+        self.assertEqual(args['history_size'], 20)
+        self.assertTrue(bfgs_keys <= set(args))
+
+        model = FakeModel()
+        make_backend(model).fit(make_init(), make_data(T - 1))
+        self.assertEqual(model.calls[0]['algorithm'], 'Newton')
+        self.assertFalse(bfgs_keys & set(model.calls[0]))
+
+        model = FakeModel()
+        make_backend(model).fit(make_init(), make_data(T), algorithm='BFGS')
+        self.assertEqual(model.calls[0]['algorithm'], 'BFGS')
+        self.assertFalse(bfgs_keys & set(model.calls[0]))
+
+    def test_fit_newton_fallback_drops_bfgs_options(self):
+        model = FakeModel(n_failures=1)
+        make_backend(model).fit(make_init(), make_data(CmdStanPyBackend.NEWTON_THRESHOLD))
+        self.assertEqual(len(model.calls), 2)
+        self.assertEqual(model.calls[1]['algorithm'], 'Newton')
+        self.assertFalse(set(CmdStanPyBackend.BFGS_OPTIONS) & set(model.calls[1]))
+
+        backend = make_backend(FakeModel(n_failures=1))
+        backend.set_options(newton_fallback=False)
+        with self.assertRaises(RuntimeError):
+            backend.fit(make_init(), make_data(CmdStanPyBackend.NEWTON_THRESHOLD))
+
+    @mock.patch.dict(os.environ, {'PATH': '/bin', 'LD_LIBRARY_PATH': '/lib'})
+    def test_add_tbb_to_path_once(self):
+        env_var = 'PATH' if models.PLATFORM == 'win' else 'LD_LIBRARY_PATH'
+        backend = make_backend(FakeModel())
+        with mock.patch.object(models, '_TBB_ADDED', False):
+            backend._add_tbb_to_path()
+            added = os.environ[env_var]
+            self.assertNotEqual(added, '/bin' if env_var == 'PATH' else '/lib')
+            backend._add_tbb_to_path()
+            self.assertEqual(os.environ[env_var], added)
+        # The path is not added again even if the flag is reset.
+        with mock.patch.object(models, '_TBB_ADDED', False):
+            backend._add_tbb_to_path()
+            self.assertEqual(os.environ[env_var], added)
+
+    @mock.patch.dict(models._STAN_THREADS_CACHE, clear=True)
+    def test_has_stan_threads_cached_per_model_file(self):
+        model = mock.Mock(exe_file='prophet_model.bin')
+        model.exe_info.return_value = {'STAN_THREADS': 'true'}
+        self.assertTrue(make_backend(model)._has_stan_threads())
+        self.assertTrue(make_backend(model)._has_stan_threads())
+        model.exe_info.assert_called_once()
+
+        other = mock.Mock(exe_file='other_model.bin')
+        other.exe_info.return_value = {'STAN_THREADS': 'false'}
+        self.assertFalse(make_backend(other)._has_stan_threads())
+
+    def test_shape_sampled_param(self):
+        column_names = (
+            'lp__', 'k', 'm', 'delta[1]', 'sigma_obs', 'beta[1]', 'beta[2]',
+        )
+        n = 5
+        draws = np.arange(n * len(column_names), dtype=float).reshape((n, -1))
+        params = CmdStanPyBackend.stan_to_dict_numpy(column_names, draws)
+        out = {
+            par: models._shape_sampled_param(par, a) for par, a in params.items()
+        }
+        for par in ('lp__', 'k', 'm', 'sigma_obs'):
+            self.assertEqual(out[par].shape, (n,))
+        self.assertEqual(out['delta'].shape, (n, 1))
+        self.assertEqual(out['beta'].shape, (n, 2))
+        self.assertTrue(np.array_equal(out['delta'][:, 0], draws[:, 3]))
+
+    def test_stan_to_dict_numpy_repeated_column(self):
+        column_names = ('k', 'm', 'k')
+        with self.assertRaises(RuntimeError):
+            CmdStanPyBackend.stan_to_dict_numpy(column_names, np.zeros((1, 3)))